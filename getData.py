@@ -1,22 +1,117 @@
+import asyncio
+import functools
+import io
+import json
 import string
 from datetime import datetime
 
-import numpy as np
+import aiohttp
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytz
 import requests
-from bs4 import BeautifulSoup
 from google.cloud import bigquery, storage
+from lxml import etree, html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 DEBUG = False
+MAX_CONCURRENT_REQUESTS = 10  # Simultaneous TDA quote requests
+MAX_RETRIES = 3  # Retries for a TDA call that is throttled or hits a server error
+RETRY_BACKOFF = 0.3  # Seconds before the first retry, doubled on each one after
+RETRY_STATUSES = [429, 500, 502, 503, 504]
 # Cloud functions use UTC so we convert to EST
 today = datetime.today().astimezone(pytz.timezone("America/New_York"))
 today_fmt = today.strftime("%Y-%m-%d")
-
-
+storage_client = storage.Client()
+
+# The symbol cell of every row after the header in the eoddata quotes table
+SYMBOL_CELLS = etree.XPath('((//table[@class="quotes"])[1]//tr)[position()>1]/td[1]')
+
+# Reuse connections for synchronous TDA calls and retry on throttling/server errors
+http_session = requests.Session()
+http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=MAX_RETRIES,
+            backoff_factor=RETRY_BACKOFF,
+            status_forcelist=RETRY_STATUSES,
+        ),
+    ),
+)
+
+# Column layout of the daily_quote_data table, matching the TDA equity quote fields
+SCHEMA = [
+    bigquery.SchemaField("symbol", "STRING"),
+    bigquery.SchemaField("description", "STRING"),
+    bigquery.SchemaField("assetType", "STRING"),
+    bigquery.SchemaField("assetMainType", "STRING"),
+    bigquery.SchemaField("cusip", "STRING"),
+    bigquery.SchemaField("bidPrice", "FLOAT64"),
+    bigquery.SchemaField("bidSize", "INT64"),
+    bigquery.SchemaField("bidId", "STRING"),
+    bigquery.SchemaField("askPrice", "FLOAT64"),
+    bigquery.SchemaField("askSize", "INT64"),
+    bigquery.SchemaField("askId", "STRING"),
+    bigquery.SchemaField("lastPrice", "FLOAT64"),
+    bigquery.SchemaField("lastSize", "INT64"),
+    bigquery.SchemaField("lastId", "STRING"),
+    bigquery.SchemaField("openPrice", "FLOAT64"),
+    bigquery.SchemaField("highPrice", "FLOAT64"),
+    bigquery.SchemaField("lowPrice", "FLOAT64"),
+    bigquery.SchemaField("bidTick", "STRING"),
+    bigquery.SchemaField("closePrice", "FLOAT64"),
+    bigquery.SchemaField("netChange", "FLOAT64"),
+    bigquery.SchemaField("totalVolume", "INT64"),
+    bigquery.SchemaField("quoteTimeInLong", "INT64"),
+    bigquery.SchemaField("tradeTimeInLong", "INT64"),
+    bigquery.SchemaField("mark", "FLOAT64"),
+    bigquery.SchemaField("exchange", "STRING"),
+    bigquery.SchemaField("exchangeName", "STRING"),
+    bigquery.SchemaField("marginable", "BOOL"),
+    bigquery.SchemaField("shortable", "BOOL"),
+    bigquery.SchemaField("volatility", "FLOAT64"),
+    bigquery.SchemaField("digits", "INT64"),
+    bigquery.SchemaField("_52WkHigh", "FLOAT64"),
+    bigquery.SchemaField("_52WkLow", "FLOAT64"),
+    bigquery.SchemaField("nAV", "FLOAT64"),
+    bigquery.SchemaField("peRatio", "FLOAT64"),
+    bigquery.SchemaField("divAmount", "FLOAT64"),
+    bigquery.SchemaField("divYield", "FLOAT64"),
+    bigquery.SchemaField("divDate", "DATE"),
+    bigquery.SchemaField("securityStatus", "STRING"),
+    bigquery.SchemaField("regularMarketLastPrice", "FLOAT64"),
+    bigquery.SchemaField("regularMarketLastSize", "INT64"),
+    bigquery.SchemaField("regularMarketNetChange", "FLOAT64"),
+    bigquery.SchemaField("regularMarketTradeTimeInLong", "INT64"),
+    bigquery.SchemaField("netPercentChangeInDouble", "FLOAT64"),
+    bigquery.SchemaField("markChangeInDouble", "FLOAT64"),
+    bigquery.SchemaField("markPercentChangeInDouble", "FLOAT64"),
+    bigquery.SchemaField("regularMarketPercentChangeInDouble", "FLOAT64"),
+    bigquery.SchemaField("delayed", "BOOL"),
+    bigquery.SchemaField("date", "DATE"),
+]
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "FLOAT64": pa.float64(),
+    "INT64": pa.int64(),
+    "BOOL": pa.bool_(),
+    "DATE": pa.date32(),
+}
+ARROW_SCHEMA = pa.schema(
+    [(field.name, ARROW_TYPES[field.field_type]) for field in SCHEMA]
+)
+
+
+@functools.lru_cache(maxsize=4)
 def fetch_api_key(bucket_name="fair-sandbox", file_name="td-key") -> str:
     """
-    Retrieves the TDA API key from Google Cloud Storage
+    Retrieves the TDA API key from Google Cloud Storage. The key is cached for
+    the lifetime of the process.
 
         Parameters:
             bucket_name (str): the name of the bucket containing the key file
@@ -25,74 +120,167 @@ def fetch_api_key(bucket_name="fair-sandbox", file_name="td-key") -> str:
         Returns:
             api_key (str): The TDA API key
     """
-    storage_client = storage.Client()
     bucket = storage_client.get_bucket(bucket_name)
     blob = bucket.blob(file_name)
-    api_key = blob.download_as_string()
+    api_key = blob.download_as_string().decode()
 
     return api_key
 
 
-def request_quote(symbol, api_key) -> pd.DataFrame:
+async def request_quote(session, semaphore, symbol, api_key) -> list:
     """
-    Retrieves quote data for a list of symbols via the TDA API.
+    Retrieves quote data for a list of symbols via the TDA API. Throttled and failed
+    requests are retried with backoff, the same as the synchronous TDA calls.
 
         Parameters:
+            session (aiohttp.ClientSession): the shared HTTP session
+            semaphore (asyncio.Semaphore): limits the number of requests in flight
             symbol (list): A list of symbols to quote
             api_key (str): The TDA API credentials
 
         Returns:
-            df_quotes (pd.DataFrame): A DataFrame containing the requested quotes.
+            quotes (list): A list of quote dicts, one per symbol
     """
     url = r"https://api.tdameritrade.com/v1/marketdata/quotes"
 
     params = {
         "apikey": api_key,
-        "symbol": symbol,
+        "symbol": ",".join(symbol),
     }
 
-    request = requests.get(url=url, params=params).json()
-    df_quotes = pd.DataFrame.from_dict(request, orient="index").reset_index(drop=True)
+    async with semaphore:
+        for attempt in range(MAX_RETRIES + 1):
+            async with session.get(url, params=params) as resp:
+                if resp.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    resp.raise_for_status()
+                    request = await resp.json()
+                    break
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+    quotes = list(request.values())
 
-    return df_quotes
+    return quotes
 
 
-def check_open() -> bool:
+@functools.lru_cache(maxsize=None)
+def fetch_open_status(date, bucket_name="fair-sandbox") -> bool:
     """
-    Returns the market open status for the day.
+    Retrieves the market open status for a date, asking TDA only the first time.
+    The result is stored in Google Cloud Storage and cached for the process.
+
+        Parameters:
+            date (str): the date to check, formatted YYYY-MM-DD
+            bucket_name (str): the name of the bucket holding the cached status
 
         Returns:
             is_open (bool): Boolean representing open status
     """
+    blob = storage_client.bucket(bucket_name).blob("market-open/{}.json".format(date))
+    if blob.exists():
+        return json.loads(blob.download_as_string())["isOpen"]
+
     # Call the TDA Hours endpoint for equities to see if it is open
     market_url = "https://api.tdameritrade.com/v1/marketdata/EQUITY/hours"
 
     params = {
         "apikey": fetch_api_key(),
-        "date": today_fmt,
+        "date": date,
     }
 
-    request = requests.get(url=market_url, params=params).json()
+    request = http_session.get(url=market_url, params=params).json()
     is_open = request["equity"]["EQ"]["isOpen"]
 
+    blob.upload_from_string(
+        json.dumps({"isOpen": is_open}), content_type="application/json"
+    )
+
     return is_open
 
 
-def chunks(full_list, n):
+def check_open() -> bool:
+    """
+    Returns the market open status for the day.
+
+        Returns:
+            is_open (bool): Boolean representing open status
+    """
+    # Markets never open on weekends, so skip the lookup entirely
+    if today.weekday() >= 5:
+        return False
+
+    return fetch_open_status(today_fmt)
+
+
+def pack_by_bytes(symbols, max_bytes):
+    """
+    Packs symbols into chunks that fit within a URL length budget.
+
+        Parameters:
+            symbols (list): the symbols that need to be chunked
+            max_bytes (int): max length of each chunk once joined with commas
+
+        Yields:
+            chunk (list): a list of symbols
+    """
+    chunk = []
+    size = 0
+
+    for symbol in symbols:
+        # Each symbol costs its own length plus a separating comma
+        cost = len(symbol) + 1
+        if chunk and size + cost > max_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(symbol)
+        size += cost
+
+    if chunk:
+        yield chunk
+
+
+async def _scrape_letter(session, letter) -> list:
     """
-    Breaks a list down into manageable chunks.
+    Downloads a single eoddata symbol listing page and reads the symbols from it.
 
         Parameters:
-            full_list (list): the list that needs to be chunked
-            n (int): max number of items per chunk
+            session (aiohttp.ClientSession): the shared HTTP session
+            letter (str): the letter of the listing page to fetch
 
         Returns:
-            chunk_list (list): a list of lists containing n items each
+            symbols (list): The symbols on the page in a readable format
+    """
+    url = "http://eoddata.com/stocklist/NYSE/{}.htm".format(letter)
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        page = await resp.read()
+
+    # A page without the quotes table would silently drop every symbol for the letter
+    cells = SYMBOL_CELLS(html.fromstring(page))
+    if not cells:
+        raise ValueError("No symbols found on the eoddata page for {}".format(letter))
+
+    # Pull the stocks from the table, removing any trailing letters or punctuation
+    symbols = []
+    for cell in cells:
+        symbol = cell.text_content().rstrip()
+        symbols.append(symbol.partition(".")[0].partition("-")[0])
+
+    return symbols
+
+
+async def _scrape_letters(alpha) -> list:
     """
-    n = max(1, n)
-    chunk_list = list((full_list[i : (i + n)] for i in range(0, len(full_list), n)))
+    Scrapes the eoddata listing pages for every letter concurrently.
 
-    return chunk_list
+        Parameters:
+            alpha (list): the letters of the listing pages to fetch
+
+        Returns:
+            symbols (list): A list of symbol lists, in the same order as alpha
+    """
+    connector = aiohttp.TCPConnector(limit=len(alpha))
+    async with aiohttp.ClientSession(connector=connector) as session:
+        return await asyncio.gather(*[_scrape_letter(session, each) for each in alpha])
 
 
 def fetch_symbols() -> list:
@@ -104,45 +292,61 @@ def fetch_symbols() -> list:
     """
     alpha = list(string.ascii_uppercase)
 
-    symbols = []
+    # Scrape every letter's page at once. Each page is parsed as soon as it
+    # arrives, while the remaining pages are still downloading
+    symbols = [s for page in asyncio.run(_scrape_letters(alpha)) for s in page]
 
-    # Loop through the letters in the alphabet to get the stocks on each page
-    # from the table and store them in a list
-    for each in alpha:
-        url = "http://eoddata.com/stocklist/NYSE/{}.htm".format(each)
-        soup = BeautifulSoup(requests.get(url).content, "html.parser")
-        table = soup.find("table", {"class": "quotes"})
-        for row in table.findAll("tr")[1:]:
-            symbols.append(row.findAll("td")[0].text.rstrip())
+    # Drop duplicates while keeping the listing order so reruns request
+    # symbols in the same order
+    symbols_clean = list(dict.fromkeys(symbols))
 
-    # Remove any trailing letters or punctuation
-    symbols_clean = []
+    return symbols_clean
 
-    for each in symbols:
-        each = each.replace(".", "-")
-        symbols_clean.append((each.split("-")[0]))
 
-    # use set() to remove duplicates
-    return list(set(symbols_clean))
+async def _get_data_async(symbols_chunked, api_key) -> list:
+    """
+    Requests quotes for every chunk of symbols concurrently.
+
+        Parameters:
+            symbols_chunked (iterable): the symbol lists to quote
+            api_key (str): The TDA API credentials
+
+        Returns:
+            quotes (list): A list of quote dict lists, one per chunk
+    """
+    # Keep the number of simultaneous calls within TDA's rate limit
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        return await asyncio.gather(
+            *[
+                request_quote(session, semaphore, sym, api_key)
+                for sym in symbols_chunked
+            ]
+        )
 
 
 def get_data() -> pd.DataFrame:
     """
-    Gathers quotes for all symbols and concatenates into a single DataFrame.
+    Gathers quotes for all symbols into a single DataFrame.
 
         Returns:
             df (pd.DataFrame): The aggregated quote data
     """
     symbols = fetch_symbols()
 
-    # The TD Ameritrade api has a limit to the number of symbols you can get data for
-    # in a single call so we chunk the list into 200 symbols at a time
-    symbols_chunked = chunks(symbols, 200)
+    # The TD Ameritrade api is limited by the length of the request URL, so we pack
+    # as many symbols into each call as fit in a safe 7500 byte budget
+    symbols_chunked = pack_by_bytes(symbols, 7500)
 
-    # Iterate through symbols and request market data.
-    df = pd.concat(
-        [request_quote(sym, fetch_api_key()) for sym in symbols_chunked], sort=False,
-    )
+    # Request market data for all chunks at once.
+    api_key = fetch_api_key()
+    quotes = []
+    for chunk in asyncio.run(_get_data_async(symbols_chunked, api_key)):
+        quotes.extend(chunk)
+
+    # Every quote shares the same schema, so build the DataFrame in one go
+    df = pd.DataFrame(quotes)
 
     return df
 
@@ -156,32 +360,40 @@ def load_data(df, dataset="equity_data", table="daily_quote_data"):
             dataset (str): the BigQuery dataset
             table (str): the BigQuery table to append data
     """
-    # Add the date and format for BigQuery
-    df["date"] = pd.to_datetime(today_fmt)
-    df["date"] = df["date"].dt.date
-    df["divDate"] = pd.to_datetime(df["divDate"])
-    df["divDate"] = df["divDate"].dt.date
-    df["divDate"] = df["divDate"].fillna(np.nan)
+    # Add the date and format for BigQuery (DATE columns need datetime.date values)
+    df["date"] = today.date()
+    df["divDate"] = pd.to_datetime(df["divDate"], errors="coerce").dt.date
 
     # Remove anything without a price
-    df = df.loc[df["bidPrice"] > 0]
+    df = df[df["bidPrice"].values > 0]
 
     # Rename columns and format for BQ (can't start with a number)
     df = df.rename(columns={"52WkHigh": "_52WkHigh", "52WkLow": "_52WkLow"})
 
+    # Match the table layout exactly so the upload agrees with the declared schema
+    df = df.reindex(columns=[field.name for field in SCHEMA])
+
     if not DEBUG:
         # Add to BigQuery
         client = bigquery.Client()
-
         dataset_ref = client.dataset(dataset)
         table_ref = dataset_ref.table(table)
 
+        # Upload as Parquet typed by SCHEMA, so columns no quote had and integers with
+        # gaps keep their declared types instead of being written as DOUBLE
+        buffer = io.BytesIO()
+        pq.write_table(
+            pa.Table.from_pandas(df, schema=ARROW_SCHEMA, preserve_index=False), buffer
+        )
+
         job_config = bigquery.LoadJobConfig()
-        job_config.source_format = bigquery.SourceFormat.CSV
-        job_config.autodetect = True
+        job_config.source_format = bigquery.SourceFormat.PARQUET
+        job_config.schema = SCHEMA
+        job_config.autodetect = False
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
         job_config.ignore_unknown_values = True
-        job = client.load_table_from_dataframe(
-            df, table_ref, location="US", job_config=job_config
+        job = client.load_table_from_file(
+            buffer, table_ref, rewind=True, location="US", job_config=job_config
         )
 
         job.result()
@@ -1,16 +1,39 @@
 #!/usr/bin/env python3
+import asyncio
 import datetime
 import string
-import time
 
+import aiohttp
 import click
-import pandas as pd
 import numpy as np
-import requests
-from bs4 import BeautifulSoup
-from pandas.core.frame import DataFrame
-from progress.bar import Bar
-from yahoofinancials import YahooFinancials as yf
+import orjson
+import pyarrow as pa
+from aiolimiter import AsyncLimiter
+from lxml import etree, html
+from pyarrow import csv
+from tqdm import tqdm
+
+YAHOO_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{}"
+YAHOO_INTERVALS = {"daily": "1d", "weekly": "1wk"}
+MAX_CONCURRENT_REQUESTS = 20
+MAX_REQUESTS_PER_SECOND = 10
+MAX_ATTEMPTS = 4  # Tries per symbol while Yahoo is throttling or erroring
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BACKOFF = 1  # Seconds before the first retry, doubled on each one after
+REQUEST_TIMEOUT = 30  # Seconds before a hung chart request is abandoned
+PRICE_SCHEMA = pa.schema(
+    [
+        ("symbol", pa.string()),
+        ("openPrice", pa.float64()),
+        ("highPrice", pa.float64()),
+        ("lowPrice", pa.float64()),
+        ("closePrice", pa.float64()),
+        ("date", pa.date32()),
+    ]
+)
+
+# The symbol cell of every row after the header in the eoddata quotes table
+SYMBOL_CELLS = etree.XPath('((//table[@class="quotes"])[1]//tr)[position()>1]/td[1]')
 
 
 def validate_date(ctx, param, value):
@@ -21,91 +44,165 @@ def validate_date(ctx, param, value):
         raise click.BadParameter("Dates must be in the format YYYY-MM-DD.")
 
 
+def progress_bar(total, desc) -> tqdm:
+    # Throttle redraws, and stay silent when not attached to a terminal
+    return tqdm(total=total, desc=desc, mininterval=0.5, disable=None)
+
+
+async def _scrape_letter(session, letter) -> list:
+    url = "http://eoddata.com/stocklist/NYSE/{}.htm".format(letter)
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        site = await resp.read()
+
+    # A page without the quotes table would silently drop every symbol for the letter
+    cells = SYMBOL_CELLS(html.fromstring(site))
+    if not cells:
+        raise ValueError("No symbols found on the eoddata page for {}".format(letter))
+
+    # Remove the extra letters on the end as each symbol is read
+    symbols = []
+    for cell in cells:
+        symbol = cell.text_content().rstrip()
+        symbols.append(symbol.partition(".")[0].partition("-")[0])
+
+    return symbols
+
+
+async def _scrape_letters(alpha) -> list:
+    # Pages complete out of order, so count them as they finish
+    bar = progress_bar(len(alpha), "Building symbol list")
+
+    connector = aiohttp.TCPConnector(limit=len(alpha))
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = []
+        for each in alpha:
+            task = asyncio.ensure_future(_scrape_letter(session, each))
+            task.add_done_callback(lambda _: bar.update())
+            tasks.append(task)
+        pages = await asyncio.gather(*tasks)
+    bar.close()
+
+    return pages
+
+
 def fetch_symbols() -> list:
     # Get a current list of all the stock symbols for the NYSE
     alpha = list(string.ascii_uppercase)
 
-    symbols = []
+    # Each page is parsed as soon as it arrives, while the rest still download
+    symbols = [s for page in asyncio.run(_scrape_letters(alpha)) for s in page]
 
-    bar = Bar("Building symbol list", max=26)
-    for each in alpha:
-        url = "http://eoddata.com/stocklist/NYSE/{}.htm".format(each)
-        resp = requests.get(url)
-        site = resp.content
-        soup = BeautifulSoup(site, "html.parser")
-        table = soup.find("table", {"class": "quotes"})
-        for row in table.findAll("tr")[1:]:
-            symbols.append(row.findAll("td")[0].text.rstrip())
-        bar.next()
-    bar.finish()
-
-    # Remove the extra letters on the end
-    symbols_clean = []
-
-    for each in symbols:
-        each = each.replace(".", "-")
-        symbols_clean.append((each.split("-")[0]))
+    # Drop the resulting duplicates
+    symbols_clean = list(dict.fromkeys(symbols))
 
     return symbols_clean
 
 
+def to_timestamp(date) -> int:
+    # Yahoo expects dates as UTC epoch seconds
+    date = datetime.datetime.strptime(date, "%Y-%m-%d")
+    return int(date.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def chart_table(symbol, chart) -> pa.Table:
+    # Yahoo returns one array per field, so each becomes a typed Arrow column as-is
+    try:
+        result = chart["chart"]["result"][0]
+        timestamps = result["timestamp"]
+        quote = result["indicators"]["quote"][0]
+        columns = {
+            "openPrice": quote["open"],
+            "highPrice": quote["high"],
+            "lowPrice": quote["low"],
+            "closePrice": quote["close"],
+        }
+    except (KeyError, IndexError, TypeError):
+        return PRICE_SCHEMA.empty_table()
+
+    columns["symbol"] = [symbol] * len(timestamps)
+    columns["date"] = np.asarray(timestamps, dtype="datetime64[s]").astype(
+        "datetime64[D]"
+    )
+
+    return pa.Table.from_pydict(columns, schema=PRICE_SCHEMA)
+
+
+async def fetch_one(symbol, sem, limiter, session, params, bar, skipped) -> pa.Table:
+    url = YAHOO_CHART_URL.format(symbol)
+
+    chart = None
+    for attempt in range(MAX_ATTEMPTS):
+        # Cap both the requests in flight and the request rate sent to Yahoo
+        async with sem, limiter:
+            try:
+                async with session.get(url, params=params) as resp:
+                    status = resp.status
+                    body = await resp.read()
+                if status == 200:
+                    chart = orjson.loads(body)
+            except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError):
+                status = None
+
+        # Only throttling, server errors and broken responses are worth another try
+        if chart is not None or status not in RETRY_STATUSES | {None}:
+            break
+        if attempt + 1 < MAX_ATTEMPTS:
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+    bar.update()
+
+    if chart is None:
+        skipped.append(symbol)
+
+    return chart_table(symbol, chart)
+
+
+async def _fetch_history(symbols, params, bar, skipped) -> list:
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = AsyncLimiter(MAX_REQUESTS_PER_SECOND, 1)
+
+    # Yahoo rejects requests without a browser-like user agent
+    headers = {"User-Agent": "Mozilla/5.0"}
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
+        return await asyncio.gather(
+            *[
+                fetch_one(s, sem, limiter, session, params, bar, skipped)
+                for s in symbols
+            ]
+        )
+
+
 def fetch_history(symbols, start_date, end_date, freq) -> list:
-    data_list = []
+    params = {
+        "period1": to_timestamp(start_date),
+        "period2": to_timestamp(end_date),
+        "interval": YAHOO_INTERVALS[freq.lower()],
+    }
 
     print("Fetching {} price history from {} to {}".format(freq, start_date, end_date))
-    bar = Bar("Fetching...", max=len(symbols))
-    for s in symbols:
-        data = yf(s)
-        hist = data.get_historical_price_data(start_date, end_date, freq)
-        data_list.append(hist)
-        time.sleep(0.5)
-        bar.next()
-    bar.finish()
+    bar = progress_bar(len(symbols), "Fetching...")
+    skipped = []
+    data_list = asyncio.run(_fetch_history(symbols, params, bar, skipped))
+    bar.close()
+
+    # Symbols Yahoo never answered for are left out of the export, so say which
+    if skipped:
+        print(
+            "Skipped {} symbols with no usable response: {}".format(
+                len(skipped), ", ".join(skipped)
+            )
+        )
 
     return data_list
 
 
-def parse_data(data) -> DataFrame:
-    df = pd.DataFrame(
-        {
-            "symbol": [],
-            "openPrice": [],
-            "highPrice": [],
-            "lowPrice": [],
-            "closePrice": [],
-            "date": [],
-        }
-    )
+def parse_data(data) -> pa.Table:
+    # Arrow concatenates the per-symbol tables without re-inferring any types
+    if not data:
+        return PRICE_SCHEMA.empty_table()
 
-    # Iterate through JSON responses and collect relevant data
-    bar = Bar("Parsing data", max=len(data))
-    for entry in data:
-        try:
-            # Fetch the ticker symbol of this entry
-            sym = list(entry.keys())[0]
-
-            # Parse data and append to dataframe
-            if entry[sym]["prices"]:
-                for row in entry[sym]["prices"]:
-                    df.loc[len(df)] = [
-                        sym,
-                        row["open"] if row["open"] else np.NaN,
-                        row["high"] if row["high"] else np.NaN,
-                        row["low"] if row["low"] else np.NaN,
-                        row["close"] if row["close"] else np.NaN,
-                        row["formatted_date"]
-                        if row["formatted_date"]
-                        else "1970-01-01",
-                    ]
-
-        except KeyError:
-            pass
-        except TypeError:
-            pass
-        bar.next()
-    bar.finish()
-
-    return df
+    return pa.concat_tables(data)
 
 
 def export_data(data, path):
@@ -113,9 +210,9 @@ def export_data(data, path):
         path = r"."
     path = path + "/back_data.csv"
 
-    # Export dataframe to CSV
+    # Export table to CSV
     try:
-        data.to_csv(path)
+        csv.write_csv(data, path)
         print("CSV file saved successfully.")
 
     except IOError as e:
@@ -1,24 +1,40 @@
+import functools
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import alpaca_trade_api as tradeapi
+import cvxpy as cp
 import numpy as np
 import pandas as pd
 from pandas.core.frame import DataFrame
 import pytz
 import requests
-from google.cloud import bigquery, storage
-from pypfopt import expected_returns, risk_models
+from google.cloud import bigquery, bigquery_storage_v1, storage
+from pypfopt import risk_models
 from pypfopt.discrete_allocation import DiscreteAllocation, get_latest_prices
-from pypfopt.efficient_frontier import EfficientFrontier
-from scipy import stats
+from pypfopt.exceptions import OptimizationError
+from sklearn.covariance import ledoit_wolf
 
 # Globals
 DEBUG = False
 alpaca_url = "https://paper-api.alpaca.markets"
 bucket_name = "fair-sandbox"  # Google Cloud Storage bucket name
 db_name = "fair-sandbox-132013"  # BigQuery database name
+MAX_ORDER_WORKERS = 8  # Concurrent order submissions to Alpaca
 today = datetime.today().astimezone(pytz.timezone("America/New_York"))
 today_fmt = today.strftime("%Y-%m-%d")
+storage_client = storage.Client()
+bigquery_client = bigquery.Client()
+
+# Columns of the strategy_log table that positions are logged to
+POSITION_SCHEMA = [
+    bigquery.SchemaField("symbol", "STRING"),
+    bigquery.SchemaField("qty", "INTEGER"),
+    bigquery.SchemaField("date", "DATE"),
+    bigquery.SchemaField("strat", "STRING"),
+]
 
 
 class Strategy:
@@ -56,7 +72,6 @@ class Momentum(Strategy):
             portfiolo_size (int): The target number of stocks to hold
 
         Methods:
-            __score(ts): Computes the momentum score for a ticker symbol
             get_buy_list(df, date, portfolio_size, cash): Computes the list of buy stocks
             prepare_df(df): Prepares the historical DataFrame by calculating momentum
     """
@@ -68,63 +83,56 @@ class Momentum(Strategy):
         self.minimum = minimum
         self.portfolio_size = portfolio_size
 
-    def __score(self, ts: pd.Series) -> int:
-        """
-        Calculates the moment score of the selected ticker symbol. For use with pandas apply().
-
-            Parameters:
-                ts (Series): A pandas Series containing info about the ticker symbol
-
-            Returns:
-                score (int): The calculated momentum score of the ticker symbol
-        """
-        x = np.arange(len(ts))
-        log_ts = np.log(ts)
-        regress = stats.linregress(x, log_ts)
-        annualized_slope = (np.power(np.exp(regress[0]), 252) - 1) * 100
-        score = annualized_slope * (regress[2] ** 2)
-        return score
-
     def get_buy_list(self, df: DataFrame, date: datetime, cash: float) -> DataFrame:
         """
         Calculates the buy stocks based on desired portfolio size, and available equity.
 
             Parameters:
-                df (DataFrame): A dataframe containing momentum-scored and filtered ticker symbols.
+                df (DataFrame): A dataframe containing momentum-scored and filtered ticker symbols,
+                    indexed by (date, symbol).
                 date (datetime): A datetime representing the most recent available market data.
                 cash (float): The total available equity.
 
             Returns:
                 df_buy (DataFrame): a DataFrame containing the optimized buy list.
         """
+        # Get the latest day's data straight from the index
+        df_latest = df.xs(date, level="date")
+
         # Filter the df to get the top momentum stocks for the latest day based on desired portfolio size
-        df_top_m = df.loc[df["date"] == pd.to_datetime(date)]
-        df_top_m = df_top_m.sort_values(by="momentum", ascending=False).head(
+        df_top_m = df_latest.sort_values(by="momentum", ascending=False).head(
             self.portfolio_size
         )
 
         # Set the universe to the top momentum stocks for the period
-        universe = df_top_m["symbol"].tolist()
-
-        # Create a df with just the stocks from the universe
-        df_u = df.loc[df["symbol"].isin(universe)]
+        universe = df_top_m.index.tolist()
 
         # Create the portfolio
-        # Pivot to format for the optimization library
-        df_u = df_u.pivot_table(
-            index="date", columns="symbol", values="close", aggfunc="sum"
+        # Slice the universe from the index and pivot to format for the optimization library
+        df_u = df.loc[(slice(None), universe), "close"].unstack("symbol")
+
+        # Calculate daily returns once, padding over missing prices like pct_change
+        prices = df_u.ffill().to_numpy(dtype=np.float64)
+        returns = prices[1:] / prices[:-1] - 1
+        observed = ~np.isnan(returns)
+
+        # Annualized compounded mean return, as in mean_historical_return
+        mu = pd.Series(
+            np.nanprod(1 + returns, axis=0) ** (252 / observed.sum(axis=0)) - 1,
+            index=df_u.columns,
         )
 
-        # Calculate expected returns and sample covariance
-        mu = expected_returns.mean_historical_return(df_u)
-        S = risk_models.sample_cov(df_u)
+        # Annualized Ledoit-Wolf shrunk covariance, which stays well conditioned on a
+        # short history. Gaps count as zero returns, as in CovarianceShrinkage
+        shrunk_cov, _ = ledoit_wolf(np.nan_to_num(returns))
+        S = risk_models.fix_nonpositive_semidefinite(
+            pd.DataFrame(shrunk_cov * 252, index=df_u.columns, columns=df_u.columns),
+            fix_method="spectral",
+        )
 
         # Optimise the portfolio for maximal Sharpe ratio
-        ef = EfficientFrontier(mu, S)
-        weights = (
-            ef.max_sharpe()
-        )  # Ignore the fact that this variable isn't referenced. EfficientFrontier is weird.
-        cleaned_weights = ef.clean_weights()
+        weights = max_sharpe(mu, S)
+        cleaned_weights = weights.where(weights.abs() >= 1e-4, 0).round(5).to_dict()
 
         # Allocate
         latest_prices = get_latest_prices(df_u)
@@ -133,22 +141,17 @@ class Momentum(Strategy):
         )
         allocation = da.lp_portfolio()[0]
 
-        # Put the stocks and the number of shares from the portfolio into a df
-        symbol_list = []
-        num_shares_list = []
+        # Now that we have the stocks we want to buy we filter the latest day for those
+        # to get the closing price
+        df_buy = df_latest.loc[df_latest.index.isin(list(allocation))].sort_index()
+        df_buy = df_buy.reset_index()
 
-        for symbol, num_shares in allocation.items():
-            symbol_list.append(symbol)
-            num_shares_list.append(num_shares)
-
-        # Now that we have the stocks we want to buy we filter the df for those
-        df_buy = df.loc[df["symbol"].isin(symbol_list)]
-
-        # Filter for the period to get the closing price
-        df_buy = df_buy.loc[df_buy["date"] == date].sort_values(by="symbol")
+        # A repeated symbol would become a repeated order for the full allocation
+        if not df_buy["symbol"].is_unique:
+            raise ValueError("Duplicate symbols in the latest day's market data.")
 
         # Add in the qty that was allocated to each stock
-        df_buy["qty"] = num_shares_list
+        df_buy["qty"] = df_buy["symbol"].map(allocation)
 
         # Calculate the amount we own for each stock
         df_buy["amount_held"] = df_buy["close"] * df_buy["qty"]
@@ -157,27 +160,153 @@ class Momentum(Strategy):
 
     def prepare_df(self, df: DataFrame) -> DataFrame:
         """
-        Prepares the DataFrame by calculating momentum.
+        Prepares the DataFrame by calculating momentum. The momentum score is the
+        annualized slope of a linear regression on log prices, weighted by r squared.
 
             Parameters:
-                df (DataFrame): A DataFrame containing historical market data
+                df (DataFrame): A DataFrame containing historical market data, indexed
+                    by (date, symbol)
 
             Returns:
                 df (DataFrame): A DataFrame containing prepared historical market data
         """
-        df["momentum"] = (
-            df.groupby("symbol")["close"]
-            .rolling(self.window, min_periods=self.minimum)
-            .apply(self.__score)
-            .reset_index(level=0, drop=True)
-        )
+        df["momentum"] = np.nan
+
+        # Symbols with less history than the minimum can never be scored, so leave them
+        # out of the calculation
+        codes = pd.factorize(df.index.get_level_values("symbol"))[0]
+        eligible = np.bincount(codes)[codes] >= self.minimum
+        if not eligible.any():
+            return df
+
+        # Lay each symbol's rows out contiguously, keeping them in date order
+        order = np.argsort(codes, kind="stable")
+        order = order[eligible[order]]
+        codes = codes[order]
+        log_close = np.log(df["close"].to_numpy(dtype=np.float64)[order])
+
+        # Where each symbol's block starts, and each row's position j within it
+        rows = np.arange(len(codes))
+        new_symbol = np.ones(len(codes), dtype=bool)
+        new_symbol[1:] = codes[1:] != codes[:-1]
+        starts = np.flatnonzero(new_symbol)
+        sizes = np.diff(np.append(starts, len(codes)))
+        j = rows - np.repeat(starts, sizes)
+
+        # Offsetting by each symbol's first price leaves slope and r unchanged but
+        # keeps the running sums small
+        valid_rows = np.where(np.isnan(log_close), len(codes), rows)
+        first = np.minimum.reduceat(valid_rows, starts)
+        offset = np.append(log_close, 0)[first]
+        y = log_close - np.repeat(offset, sizes)
+
+        # Regress y on x = 0..n-1 over each window in closed form. Window sums are
+        # differences of running sums, which never cross a symbol boundary since each
+        # window starts at or after its symbol's first row
+        n = np.minimum(j + 1, self.window)
+        window_start = rows - n + 1
+        missing = np.isnan(y)
+        y = np.where(missing, 0, y)
+
+        def window_sum(values):
+            running = np.concatenate(([0], np.cumsum(values)))
+            return running[rows + 1] - running[window_start]
+
+        sy = window_sum(y)
+        syy = window_sum(y ** 2)
+        sxy = window_sum(j * y) - (j - n + 1) * sy
+        sx = n * (n - 1) / 2
+        sxx = (n - 1) * n * (2 * n - 1) / 6
+
+        cov = n * sxy - sx * sy
+        var_x = n * sxx - sx ** 2
+        var_y = n * syy - sy ** 2
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = cov / var_x
+            r_squared = np.where(var_y > 0, cov ** 2 / (var_x * var_y), 0)
+        annualized_slope = (np.exp(slope * 252) - 1) * 100
+
+        # Windows that are too short or contain missing prices don't get a score
+        valid = (n >= self.minimum) & (window_sum(missing) == 0)
+        momentum = np.full(len(df), np.nan)
+        momentum[order] = np.where(valid, annualized_slope * r_squared, np.nan)
+        df["momentum"] = momentum
 
         return df
 
 
+@functools.lru_cache(maxsize=None)
+def max_sharpe_problem(n: int) -> tuple:
+    """
+    Builds the long-only max Sharpe problem for n assets, using the same variable
+    transformation as PyPortfolioOpt's EfficientFrontier.max_sharpe. The inputs are
+    cvxpy Parameters, so the problem is only compiled once per size and re-solved with
+    new values afterwards.
+
+        Parameters:
+            n (int): The number of assets
+
+        Returns:
+            problem (tuple): The problem, the excess return and covariance root
+                parameters, and the transformed weight and scale variables
+    """
+    excess_returns = cp.Parameter(n)
+    cov_root = cp.Parameter((n, n))
+    w = cp.Variable(n)
+    k = cp.Variable()
+
+    problem = cp.Problem(
+        cp.Minimize(cp.sum_squares(cov_root.T @ w)),
+        [excess_returns @ w == 1, cp.sum(w) == k, k >= 0, w >= 0, w <= k],
+    )
+    return problem, excess_returns, cov_root, w, k
+
+
+def max_sharpe(mu: pd.Series, S: DataFrame, risk_free_rate: float = 0.02) -> pd.Series:
+    """
+    Finds the long-only portfolio weights that maximise the Sharpe ratio. When the
+    unconstrained tangency portfolio is already long-only it is the answer, and is taken
+    in closed form. Otherwise the constrained problem is solved with cvxpy.
+
+        Parameters:
+            mu (Series): Expected annual returns per symbol
+            S (DataFrame): The annualized covariance matrix, positive semidefinite
+            risk_free_rate (float): The annual risk-free rate
+
+        Returns:
+            weights (Series): The Sharpe-maximising weights per symbol
+    """
+    excess = mu.to_numpy() - risk_free_rate
+
+    # Tangency portfolio, proportional to S^-1 (mu - rf)
+    try:
+        tangency = np.linalg.solve(S.to_numpy(), excess)
+    except np.linalg.LinAlgError:
+        tangency = None
+    if tangency is not None and tangency.sum() > 0 and (tangency >= 0).all():
+        return pd.Series(tangency / tangency.sum(), index=mu.index)
+
+    problem, excess_returns, cov_root, w, k = max_sharpe_problem(len(mu))
+
+    # S = root @ root.T, which keeps the objective DPP so the compiled problem is reused
+    eigenvalues, eigenvectors = np.linalg.eigh(S.to_numpy())
+    excess_returns.value = excess
+    cov_root.value = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+
+    problem.solve()
+    if problem.status not in ("optimal", "optimal_inaccurate"):
+        raise OptimizationError("Solver status: {}".format(problem.status))
+
+    # Inverse-transform
+    return pd.Series((w.value / k.value).round(16) + 0.0, index=mu.index)
+
+
+@functools.lru_cache(maxsize=4)
 def fetch_api_key(vendor: str, bucket_name: str) -> tuple:
     """
-    Retrieves the appropriate API key from Google Cloud Storage
+    Retrieves the appropriate API key from Google Cloud Storage. The key is cached
+    for the lifetime of the process.
 
         Parameters:
             vendor (str): either "tda" or "alpaca"
@@ -186,7 +315,6 @@ def fetch_api_key(vendor: str, bucket_name: str) -> tuple:
         Returns:
             api_key (tuple): The requested API key
     """
-    storage_client = storage.Client()
     bucket = storage_client.get_bucket(bucket_name)
 
     if vendor == "tda":
@@ -203,28 +331,56 @@ def fetch_api_key(vendor: str, bucket_name: str) -> tuple:
     return api_key
 
 
-def check_open() -> bool:
+@functools.lru_cache(maxsize=None)
+def fetch_open_status(date: str, bucket_name: str) -> bool:
     """
-    Returns the market open status for the day.
+    Retrieves the market open status for a date, asking TDA only the first time.
+    The result is stored in Google Cloud Storage and cached for the process.
+
+        Parameters:
+            date (str): the date to check, formatted YYYY-MM-DD
+            bucket_name (str): the name of the bucket holding the cached status
 
         Returns:
             is_open (bool): Boolean representing open status
     """
+    blob = storage_client.bucket(bucket_name).blob("market-open/{}.json".format(date))
+    if blob.exists():
+        return json.loads(blob.download_as_string())["isOpen"]
+
     # Call the TDA Hours endpoint for equities to see if it is open
     market_url = "https://api.tdameritrade.com/v1/marketdata/EQUITY/hours"
 
     api_key, _ = fetch_api_key("tda", bucket_name)
     params = {
         "apikey": api_key,
-        "date": today_fmt,
+        "date": date,
     }
 
     request = requests.get(url=market_url, params=params).json()
     is_open = request["equity"]["EQ"]["isOpen"]
 
+    blob.upload_from_string(
+        json.dumps({"isOpen": is_open}), content_type="application/json"
+    )
+
     return is_open
 
 
+def check_open() -> bool:
+    """
+    Returns the market open status for the day.
+
+        Returns:
+            is_open (bool): Boolean representing open status
+    """
+    # Markets never open on weekends, so skip the lookup entirely
+    if today.weekday() >= 5:
+        return False
+
+    return fetch_open_status(today_fmt, bucket_name)
+
+
 def get_sell_data(
     df: DataFrame, df_pf: DataFrame, sell_list: list, date: datetime
 ) -> DataFrame:
@@ -232,7 +388,8 @@ def get_sell_data(
     Compares the existing portfolio to the buy list to determine which stocks to sell.
 
         Parameters:
-            df (DataFrame): The DataFrame containing momentum scored stock data
+            df (DataFrame): The DataFrame containing momentum scored stock data,
+                indexed by (date, symbol)
             df_pf (DataFrame): A DataFrame containing current portfolio data
             sell_list (list): A list of symbols to divest
             date (datetime): A datetime representing the most recent market data
@@ -241,21 +398,19 @@ def get_sell_data(
             df_sell (DataFrame): A DataFrame containing market data for sell stocks
     """
     # Get the current prices and the number of shares to sell
-    df_sell_price = df.loc[df["date"] == pd.to_datetime(date)]
+    df_sell_price = df.xs(date, level="date")
 
     # Filter
-    df_sell_price = df_sell_price.loc[df_sell_price["symbol"].isin(sell_list)]
+    df_sell_price = df_sell_price.loc[df_sell_price.index.isin(sell_list), ["close"]]
 
     # Check to see if there are any stocks in the current ones to buy
     # that are not in the current portfolio. It's possible there may not be any
     if df_sell_price.shape[0] > 0:
-        df_sell_price = df_sell_price[["symbol", "close"]]
-
-        # Merge with the current pf to get the number of shares we bought initially
+        # Join with the current pf to get the number of shares we bought initially
         # so we know how many to sell
-        df_buy_shares = df_pf[["symbol", "qty"]]
+        df_buy_shares = df_pf.set_index("symbol")["qty"]
 
-        df_sell = pd.merge(df_sell_price, df_buy_shares, on="symbol", how="left")
+        df_sell = df_sell_price.join(df_buy_shares, how="left").reset_index()
 
     else:
         df_sell = None
@@ -275,12 +430,14 @@ def diff_stocks(df_sell: DataFrame, df_pf: DataFrame, df_buy: DataFrame) -> Data
         Returns:
             df_sell_final (DataFrame): A DataFrame containing the finalized sell order data
     """
-    df_stocks_held_prev = df_pf[["symbol", "qty"]]
+    df_stocks_held_prev = df_pf.set_index("symbol")["qty"]
     df_stocks_held_curr = df_buy[["symbol", "qty", "close"]]
 
-    # Inner merge to get the stocks that are the same week to week
-    df_stock_diff = pd.merge(
-        df_stocks_held_curr, df_stocks_held_prev, on="symbol", how="inner"
+    # Inner join to get the stocks that are the same week to week
+    df_stock_diff = (
+        df_stocks_held_curr.set_index("symbol")
+        .join(df_stocks_held_prev, how="inner", lsuffix="_x", rsuffix="_y")
+        .reset_index()
     )
 
     # Check to make sure not all of the stocks are different compared to what we have in the pf
@@ -301,29 +458,27 @@ def diff_stocks(df_sell: DataFrame, df_pf: DataFrame, df_buy: DataFrame) -> Data
         # add the df with the stocks that dropped out of the pf
         if df_stock_diff_sale.shape[0] > 0:
             if df_sell is not None:
-                df_sell_final = pd.concat([df_sell, df_stock_diff_sale], sort=True)
+                df_sell_final = pd.concat(
+                    [df_sell, df_stock_diff_sale], sort=False, copy=False
+                )
                 # Fill in NaNs in the share amount change column with
                 # the qty of the stocks no longer in the pf, then drop the qty columns
                 df_sell_final["share_amt_change"] = df_sell_final[
                     "share_amt_change"
                 ].fillna(df_sell_final["qty"])
-                df_sell_final = df_sell_final.drop(["qty"], 1)
+                df_sell_final = df_sell_final.drop(columns=["qty"])
                 # Turn the negative numbers into positive for the order
                 df_sell_final["share_amt_change"] = np.abs(
-                    df_sell_final["share_amt_change"]
-                )
-                df_sell_final.columns = df_sell_final.columns.str.replace(
-                    "share_amt_change", "qty"
+                    df_sell_final["share_amt_change"].to_numpy()
                 )
+                df_sell_final = df_sell_final.rename(columns={"share_amt_change": "qty"})
             else:
                 df_sell_final = df_stock_diff_sale
                 # Turn the negative numbers into positive for the order
                 df_sell_final["share_amt_change"] = np.abs(
-                    df_sell_final["share_amt_change"]
-                )
-                df_sell_final.columns = df_sell_final.columns.str.replace(
-                    "share_amt_change", "qty"
+                    df_sell_final["share_amt_change"].to_numpy()
                 )
+                df_sell_final = df_sell_final.rename(columns={"share_amt_change": "qty"})
         else:
             df_sell_final = None
     else:
@@ -343,8 +498,12 @@ def get_buy_data(df_pf: DataFrame, df_buy: DataFrame) -> DataFrame:
         Returns:
             df_buy_new (DataFrame): A DataFrame containing finalized buy order data
     """
-    # Left merge to get any new stocks or see if they changed qty
-    df_buy_new = pd.merge(df_buy, df_pf, on="symbol", how="left")
+    # Left join to get any new stocks or see if they changed qty
+    df_buy_new = (
+        df_buy.set_index("symbol")
+        .join(df_pf.set_index("symbol"), how="left", lsuffix="_x", rsuffix="_y")
+        .reset_index()
+    )
 
     # Get the qty we need to increase our positions by
     df_buy_new = df_buy_new.fillna(0)
@@ -363,24 +522,57 @@ def get_buy_data(df_pf: DataFrame, df_buy: DataFrame) -> DataFrame:
 
 def get_hist_data() -> DataFrame:
     """
-    Fetches historical market data from BigQuery and normalizes.
+    Fetches historical market data from BigQuery and normalizes. The query result is
+    cached in Google Cloud Storage as Parquet, and reused until the table changes.
 
         Returns:
-            df (DataFrame): A DataFrame containing normalized historical data.
+            df (DataFrame): A DataFrame containing normalized historical data, indexed by
+                (date, symbol).
     """
-    # Establish BigQuery connection
-    client = bigquery.Client()
-    query_str = "SELECT symbol, closePrice, date FROM `{0}.equity_data.daily_quote_data`".format(
-        db_name
+    table_id = "{0}.equity_data.daily_quote_data".format(db_name)
+    table = bigquery_client.get_table(table_id)
+
+    # Identify the table's current contents, including rows still being streamed in
+    buffered_rows = 0
+    if table.streaming_buffer is not None:
+        buffered_rows = table.streaming_buffer.estimated_rows
+    table_version = "{}/{}/{}".format(
+        table.modified.isoformat(), table.num_rows, buffered_rows
     )
 
-    # Execute query and build DataFrame
-    df = client.query(query_str).to_dataframe()
+    bucket = storage_client.bucket(bucket_name)
+    blob = bucket.get_blob("cache/daily_quote_data.parquet")
 
-    # Normalize data for processing
-    df["date"] = pd.to_datetime(df["date"])
-    df = df.sort_values(by="date").reset_index(drop=True)
-    df = df.rename(columns={"closePrice": "close"})
+    if blob is not None and (blob.metadata or {}).get("table_version") == table_version:
+        df = pd.read_parquet(io.BytesIO(blob.download_as_string()))
+    else:
+        query_str = "SELECT symbol, closePrice, date FROM `{0}`".format(table_id)
+
+        # Execute query and download through the Storage Read API as Arrow
+        df = (
+            bigquery_client.query(query_str)
+            .result()
+            .to_arrow(bqstorage_client=bigquery_storage_v1.BigQueryReadClient())
+            .to_pandas(date_as_object=False)
+        )
+
+        # Overwrite the cache, tagged with the table state it was read from
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+        blob = bucket.blob("cache/daily_quote_data.parquet")
+        blob.metadata = {"table_version": table_version}
+        blob.upload_from_string(
+            buffer.getvalue(), content_type="application/octet-stream"
+        )
+
+    # Normalize data for processing, indexed by (date, symbol) for fast lookups. The
+    # index keeps each symbol once as a level, and closes only need single precision
+    df = df.rename(columns={"closePrice": "close"}).astype({"close": np.float32})
+    df = df.set_index(["date", "symbol"]).sort_index()
+
+    # A repeated data load leaves the same quote twice, which would otherwise be
+    # picked and ordered twice. Keep one close per date and symbol
+    df = df[~df.index.duplicated(keep="last")]
 
     return df
 
@@ -392,49 +584,81 @@ def log_positions(positions: list) -> None:
         Parameters:
             positions (list): The list of positions to log.
     """
-    client = bigquery.Client()
-
-    symbol, qty, market_value = [], [], []
-
-    for p in positions:
-        symbol.append(p.symbol)
-        qty.append(int(p.qty))
-
-    # New position df
-    position_df = pd.DataFrame({"symbol": symbol, "qty": qty})
-
-    # Add the current date and other info into the portfolio df for logging
-    position_df["date"] = pd.to_datetime(today_fmt)
-    position_df["strat"] = "momentum_strat_1"
-
-    # Add the new pf to BQ
-    # Format date to match schema
-    position_df["date"] = position_df["date"].dt.date
+    # New position rows, with the current date (formatted to match the schema)
+    # and other info added for logging
+    rows = [
+        {
+            "symbol": p.symbol,
+            "qty": int(p.qty),
+            "date": today_fmt,
+            "strat": "momentum_strat_1",
+        }
+        for p in positions
+    ]
 
     # Append it to the anomaly table
     dataset_id = "equity_data"
     table_id = "strategy_log"
 
-    dataset_ref = client.dataset(dataset_id)
+    dataset_ref = bigquery_client.dataset(dataset_id)
     table_ref = dataset_ref.table(table_id)
 
     job_config = bigquery.LoadJobConfig()
-    job_config.source_format = bigquery.SourceFormat.CSV
-    job_config.autodetect = True
+    job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+    job_config.schema = POSITION_SCHEMA
     job_config.ignore_unknown_values = True
 
-    job = client.load_table_from_dataframe(
-        position_df, table_ref, location="US", job_config=job_config
+    job = bigquery_client.load_table_from_json(
+        rows, table_ref, location="US", job_config=job_config
     )
 
     job.result()
 
 
+def submit_orders(api: tradeapi.REST, df_order: DataFrame, side: str) -> list:
+    """
+    Submits a market order for each row of an order DataFrame. Orders are sent
+    concurrently since each one is an independent REST round-trip. A rejected order
+    doesn't stop the others, and is logged instead.
+
+        Parameters:
+            api (REST): An authenticated Alpaca REST client
+            df_order (DataFrame): A DataFrame with symbol and qty columns
+            side (str): The order side, "buy" or "sell"
+
+        Returns:
+            failed (list): A (symbol, qty, exception) tuple for each order that failed
+    """
+
+    def submit(symbol: str, qty: int):
+        try:
+            api.submit_order(
+                symbol=symbol,
+                qty=qty,
+                side=side,
+                type="market",
+                time_in_force="day",
+            )
+        except Exception as err:
+            return symbol, qty, err
+
+    with ThreadPoolExecutor(max_workers=MAX_ORDER_WORKERS) as executor:
+        results = executor.map(
+            submit, df_order["symbol"].tolist(), df_order["qty"].tolist()
+        )
+        failed = [result for result in results if result is not None]
+
+    for symbol, qty, err in failed:
+        print("Failed to {} {} shares of {}: {}".format(side, qty, symbol, err))
+
+    return failed
+
+
 def trade() -> None:
     df = get_hist_data()
-    current_data_date = df[
+    current_data_date = df.index.get_level_values(
         "date"
-    ].max()  # Find the most recent date for which we have data.
+    ).max()  # Find the most recent date for which we have data.
 
     # Set up Alpaca connection for trading
     key_id, secret_key = fetch_api_key("alpaca", bucket_name)
@@ -444,12 +668,10 @@ def trade() -> None:
     positions = api.list_positions()
 
     # Convert positions to DataFrame for processing.
-    symbol, qty, market_value = [], [], []
-    for p in positions:
-        symbol.append(p.symbol)
-        qty.append(int(p.qty))
-        market_value.append(float(p.market_value))
-    df_pf = pd.DataFrame({"symbol": symbol, "qty": qty, "market_value": market_value})
+    df_pf = pd.DataFrame.from_records(
+        [(p.symbol, int(p.qty), float(p.market_value)) for p in positions],
+        columns=["symbol", "qty", "market_value"],
+    )
     if DEBUG:
         print("Current Portfolio:\n", df_pf)
 
@@ -476,19 +698,7 @@ def trade() -> None:
         if DEBUG:
             print("Sell Order:\n", df_sell)
         else:
-            symbol_list = df_sell["symbol"].tolist()
-            qty_list = df_sell["qty"].tolist()
-            try:
-                for symbol, qty in list(zip(symbol_list, qty_list)):
-                    api.submit_order(
-                        symbol=symbol,
-                        qty=qty,
-                        side="sell",
-                        type="market",
-                        time_in_force="day",
-                    )
-            except Exception:
-                pass  # TODO: Should probably handle this more gracefully
+            submit_orders(api, df_sell, "sell")
 
     # Finalize and execute buy order
     df_buy = get_buy_data(df_pf, df_buy)
@@ -496,19 +706,7 @@ def trade() -> None:
         if DEBUG:
             print("Buy Order:\n", df_buy)
         else:
-            symbol_list = df_buy["symbol"].tolist()
-            qty_list = df_buy["qty"].tolist()
-            try:
-                for symbol, qty in list(zip(symbol_list, qty_list)):
-                    api.submit_order(
-                        symbol=symbol,
-                        qty=qty,
-                        side="buy",
-                        type="market",
-                        time_in_force="day",
-                    )
-            except Exception:
-                pass  # TODO: Handle this more gracefully also
+            submit_orders(api, df_buy, "buy")
 
     # Log new positions to BigQuery for future reference
     if not DEBUG: